@@ -1,96 +1,446 @@
 import os
-import io
 import json
+import base64
+import fcntl
+import mmap
+import hashlib
+import re
 import textwrap
 import tempfile
-
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeout, wait
+from contextlib import ExitStack
+from functools import partial
+
+import diskcache
+import httpx
+import numpy as np
+import orjson
+from numba import njit
 from flask import Flask, request, send_file, render_template
 from openai import OpenAI
-import pdfplumber
+import pypdfium2 as pdfium
 from pypdf import PdfReader, PdfWriter
-from reportlab.pdfgen import canvas
-
-# Uses OPENAI_API_KEY from your environment
-client = OpenAI()
+from pypdf.generic import ContentStream, DictionaryObject, NameObject
+
+# Uses OPENAI_API_KEY from your environment.
+# Requests run in parallel from a thread pool. HTTP/2 multiplexes them
+# over one connection instead of a TLS handshake per request, and the
+# pool is sized so the worker threads don't queue behind each other.
+# Timeouts and retries here are per attempt; the overall limit is
+# MODEL_STAGE_BUDGET below.
+MAX_PAGE_WORKERS = 8
+client = OpenAI(
+    max_retries=2,
+    timeout=httpx.Timeout(60.0, connect=5.0),
+    http_client=httpx.Client(
+        http2=True,
+        limits=httpx.Limits(max_connections=32, max_keepalive_connections=32),
+    ),
+)
 app = Flask(__name__)
 
+FILL_MODEL = "gpt-5-mini"
+
+# Bump this whenever the fill prompt changes so stale cached answers
+# are no longer hit.
+FILL_PROMPT_VERSION = "fillv3"
+
+# Pages are sent to the model several at a time, so the long instructions
+# are paid for once per batch. Batches stay modest because output tokens
+# are generated serially within a request; separate batches still run in
+# parallel.
+MAX_BATCH_PAGES = 8
+MAX_BATCH_CHARS = 24000  # roughly 6k input tokens of page text
+
+# Wall-clock seconds for ALL model work on one upload (cache embeddings
+# and fill batches, retries included). Pages not answered by then are
+# left blank, so the response goes out before gunicorn's 120s worker
+# timeout (gunicorn.conf.py) kills the worker. The rest of the 120s is
+# for saving the upload and reading/writing the PDF.
+MODEL_STAGE_BUDGET = 90.0
+
+# Answers keyed by a hash of everything that goes into the prompt, so a
+# re-uploaded worksheet (or a repeated page) skips the model entirely.
+LLM_CACHE_DIR = os.environ.get("LLM_CACHE_DIR", "./.llm_cache")
+llm_cache = diskcache.Cache(LLM_CACHE_DIR)
+
+# Second cache tier: pages that differ only by a name, date or number
+# embed almost identically, so their answers can be reused.
+EMBEDDING_MODEL = "text-embedding-3-small"
+SEMANTIC_MATCH_THRESHOLD = 0.97
+SEMANTIC_MIN_WORDS = 30  # short pages match each other too easily
+SEMANTIC_CACHE_DIR = os.path.join(LLM_CACHE_DIR, "semantic")
+# Records are about 10 KB each (mostly the embedding), so this keeps
+# roughly the newest 1,500-3,000 pages; every worker holds them in memory.
+SEMANTIC_CACHE_MAX_BYTES = 32 * 1024 * 1024
+
 
 # ---------- BASIC PDF TEXT EXTRACTION ----------
 
-def extract_pages(pdf_path):
-    """Return a list of text strings, one per page."""
+IO_BUFFER_SIZE = 1024 * 1024
+MMAP_MIN_BYTES = 8 * 1024 * 1024  # memory-map inputs at least this big
+
+# Below these sizes a page is treated as image-only (e.g. scanned) and
+# skipped: no model call, no anchoring.
+MIN_PAGE_CHARS = 20
+MIN_PAGE_TEXT = 10
+
+TRAILING_SPACE_RE = re.compile(r"[ \t]+$", re.M)
+BLANK_LINES_RE = re.compile(r"\n{3,}")
+
+
+def open_pdf_stream(pdf_path, stack):
+    """
+    Open a PDF for random-access reading, registered on `stack` for cleanup.
+
+    Large files are memory-mapped so pypdf reads straight from the page
+    cache; smaller ones use a file with a large read buffer. (PDFium is
+    given the path and does its own file I/O in C.)
+    """
+    f = stack.enter_context(open(pdf_path, "rb", buffering=IO_BUFFER_SIZE))
+    if os.fstat(f.fileno()).st_size >= MMAP_MIN_BYTES:
+        return stack.enter_context(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    return f
+
+
+def compact_page_text(text):
+    """
+    Normalize line breaks, drop trailing whitespace on each line and
+    collapse runs of blank lines. Fewer input tokens, same content.
+    """
+    text = TRAILING_SPACE_RE.sub("", text.replace("\r\n", "\n"))
+    return BLANK_LINES_RE.sub("\n\n", text).strip()
+
+
+def read_page_text(textpage):
+    """
+    Return the compacted text of one PDFium text page, or None if the page
+    has (almost) no text layer -- typically a scanned image. Such pages are
+    detected from the character count before any text is decoded.
+    """
+    if textpage.count_chars() < MIN_PAGE_CHARS:
+        return None
+    text = compact_page_text(textpage.get_text_range())
+    if len(text) < MIN_PAGE_TEXT:
+        return None
+    return text
+
+
+def extract_pages(pdf_doc):
+    """
+    Return a list of text strings, one per page of an open PDFium document.
+    Pages without a usable text layer (see read_page_text) are None.
+    """
     pages_text = []
-    with pdfplumber.open(pdf_path) as pdf:
-        for page in pdf.pages:
-            text = page.extract_text() or ""
-            pages_text.append(text)
+    for i in range(len(pdf_doc)):
+        pdf_page = pdf_doc[i]
+        textpage = pdf_page.get_textpage()
+        try:
+            pages_text.append(read_page_text(textpage))
+        finally:
+            textpage.close()
+            pdf_page.close()
     return pages_text
 
 
+def extract_worksheet_pages(pdf_doc):
+    """
+    Read everything the pipeline needs from the worksheet in ONE pass.
+
+    Returns (pages_text, words_by_page). Word positions (see
+    extract_page_words) are only kept for pages that could hold fill
+    items; other entries are None. Each page is loaded once and closed
+    straight away, so PDFium never holds more than one page and the
+    document can be closed before the (slow) model stage.
+    """
+    pages_text = []
+    words_by_page = []
+    for i in range(len(pdf_doc)):
+        pdf_page = pdf_doc[i]
+        textpage = pdf_page.get_textpage()
+        try:
+            text = read_page_text(textpage)
+            words = None
+            if text and FILLABLE_RE.search(text):
+                words = extract_page_words(textpage)
+        finally:
+            textpage.close()
+            pdf_page.close()
+        pages_text.append(text)
+        words_by_page.append(words)
+    return pages_text, words_by_page
+
+
+def extract_page_words(textpage):
+    """
+    Split a PDFium text page into whitespace-separated words.
+
+    Returns (texts, x0, y0): the word strings plus two parallel float32
+    arrays in PDF coordinates (origin bottom-left), where x0 is each
+    word's left edge and y0 its lowest point, using PDFium's loose
+    (font-height) character boxes.
+    """
+    texts = []
+    lefts = []
+    bottoms = []
+    chars = []
+    x0 = y0 = None
+    for i in range(textpage.count_chars()):
+        ch = chr(pdfium.raw.FPDFText_GetUnicode(textpage, i))
+        if ch.isspace() or ch == "\0":
+            if chars:
+                texts.append("".join(chars))
+                lefts.append(x0)
+                bottoms.append(y0)
+                chars = []
+            continue
+        left, bottom, _right, _top = textpage.get_charbox(i, loose=True)
+        if not chars:
+            x0, y0 = left, bottom
+        else:
+            x0, y0 = min(x0, left), min(y0, bottom)
+        chars.append(ch)
+    if chars:
+        texts.append("".join(chars))
+        lefts.append(x0)
+        bottoms.append(y0)
+    return texts, np.array(lefts, dtype=np.float32), np.array(bottoms, dtype=np.float32)
+
+
 def extract_reference_text(pdf_path, max_chars=6000):
     """
     Extract text from a reference PDF (reading/article).
     We cap length so we don't explode token usage.
     """
     chunks = []
-    with pdfplumber.open(pdf_path) as pdf:
-        for page in pdf.pages:
-            t = page.extract_text()
+    pdf_doc = pdfium.PdfDocument(pdf_path)
+    try:
+        for t in extract_pages(pdf_doc):
             if t:
                 chunks.append(t)
+    finally:
+        pdf_doc.close()
     joined = "\n\n".join(chunks)
     if len(joined) > max_chars:
         return joined[:max_chars]
     return joined
 
 
-# ---------- ASK THE MODEL WHAT TO FILL ----------
+def fill_context_key(custom_instructions="", reference_text=""):
+    """Hash of everything besides the page text that shapes the answers."""
+    h = hashlib.sha256()
+    for part in (FILL_PROMPT_VERSION, FILL_MODEL, custom_instructions.strip(),
+                 reference_text.strip()):
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
 
-def get_fill_items_from_text(page_text, custom_instructions="", reference_text=""):
-    """
-    Ask the model to find EVERY thing a student is supposed to fill in on this page:
-    - Questions
-    - Sentences with blanks
-    - Bullet prompts that obviously want answers
 
-    Returns a list like:
-    [
-      {"prompt": "...line or question exactly as on the page...", "answer": "...short answer..."},
-      ...
-    ]
-    """
-    if not page_text.strip():
-        return []
+def fill_cache_key(page_text, custom_instructions="", reference_text=""):
+    """Exact-match cache key for one page's fill items."""
+    context = fill_context_key(custom_instructions, reference_text)
+    return hashlib.sha256(f"{context}|{page_text}".encode("utf-8")).hexdigest()
 
-    # Optional context blocks
-    extra_instr_block = ""
-    if custom_instructions.strip():
-        extra_instr_block = f"""
-ADDITIONAL WORKSHEET INSTRUCTIONS FROM THE USER:
-\"\"\"{custom_instructions.strip()}\"\"\""""
 
-    ref_block = ""
-    if reference_text.strip():
-        ref_block = f"""
-REFERENCE READING / ARTICLE (use this to answer whenever relevant):
-\"\"\"{reference_text.strip()}\"\"\""""
+# ---------- SEMANTIC CACHE ----------
+#
+# Stored as one append-only records.jsonl; each line holds a unit-length
+# float32 page embedding (base64) together with the answers for that
+# page, so an embedding can never drift out of line with its answers.
+# Each record carries the context key so answers are only reused for
+# the same prompt version, instructions and reference text.
+#
+# Several processes (gunicorn workers) may share LLM_CACHE_DIR: writers
+# append under an exclusive flock, readers read under a shared one, and
+# each process keeps a byte offset and picks up lines other processes
+# appended since its last look.
+#
+# Once the file passes SEMANTIC_CACHE_MAX_BYTES, the writer that noticed
+# rewrites it in place with only the newest half of the records, under a
+# new generation id on its first line. A process that sees a different
+# generation drops what it has and reloads from the top.
 
-    prompt = f"""
-You are helping with a school worksheet.
+_semantic_lock = threading.Lock()
+_semantic_embeddings = None
+_semantic_records = []
+_semantic_offset = 0
+_semantic_generation = None
 
-You are given:
-1) The FULL text of ONE worksheet page.
-{extra_instr_block}
-{ref_block}
 
-The worksheet page may include:
+def _semantic_cache_path():
+    return os.path.join(SEMANTIC_CACHE_DIR, "records.jsonl")
+
+
+def _semantic_header():
+    return (json.dumps({"generation": os.urandom(8).hex()}) + "\n").encode("utf-8")
+
+
+def _read_semantic_header(f):
+    """Return (generation, header length) for the file's first line."""
+    f.seek(0)
+    line = f.readline()
+    try:
+        header = json.loads(line)
+    except ValueError:
+        return None, 0
+    if not isinstance(header, dict) or "generation" not in header:
+        return None, 0
+    return header["generation"], len(line)
+
+
+def _sync_semantic_cache():
+    """Load records appended since the last sync (caller holds the lock)."""
+    global _semantic_embeddings, _semantic_records, _semantic_offset, _semantic_generation
+    try:
+        with open(_semantic_cache_path(), "rb") as f:
+            fcntl.flock(f, fcntl.LOCK_SH)
+            try:
+                generation, header_len = _read_semantic_header(f)
+                if generation != _semantic_generation:
+                    # Compacted since our last look: start over.
+                    _semantic_embeddings = None
+                    _semantic_records = []
+                    _semantic_offset = header_len
+                    _semantic_generation = generation
+                f.seek(_semantic_offset)
+                data = f.read()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+    except FileNotFoundError:
+        return
+    except OSError as e:
+        print(f"Warning: could not read semantic cache: {e}")
+        return
+
+    # Only whole lines; a torn tail (e.g. after a crash) is left for later.
+    end = data.rfind(b"\n") + 1
+    if not end:
+        return
+    _semantic_offset += end
+
+    rows = []
+    for line in data[:end].splitlines():
+        try:
+            record = json.loads(line)
+            row = np.frombuffer(base64.b64decode(record.pop("embedding")), dtype=np.float32)
+        except (ValueError, KeyError, TypeError) as e:
+            print(f"Warning: skipping bad semantic cache record: {e}")
+            continue
+        if rows and row.shape != rows[0].shape:
+            continue
+        if _semantic_embeddings is not None and row.shape[0] != _semantic_embeddings.shape[1]:
+            continue
+        rows.append(row)
+        _semantic_records.append(record)
+
+    if rows:
+        new = np.vstack(rows)
+        _semantic_embeddings = new if _semantic_embeddings is None else np.vstack([_semantic_embeddings, new])
+
+
+def embed_page_text(page_text):
+    """Return a unit-length float32 embedding of the page text."""
+    response = client.embeddings.create(model=EMBEDDING_MODEL, input=page_text)
+    vec = np.asarray(response.data[0].embedding, dtype=np.float32)
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm else vec
+
+
+def semantic_cache_lookup(embedding, context_key):
+    """Return cached fill items for a near-identical page, or None."""
+    with _semantic_lock:
+        _sync_semantic_cache()
+        if _semantic_embeddings is None or not len(_semantic_records):
+            return None
+        if _semantic_embeddings.shape[1] != embedding.shape[0]:
+            return None
+        scores = _semantic_embeddings @ embedding
+        for idx in np.argsort(scores)[::-1]:
+            if scores[idx] <= SEMANTIC_MATCH_THRESHOLD:
+                return None
+            record = _semantic_records[idx]
+            if record.get("context") == context_key:
+                return record["items"]
+    return None
+
+
+def semantic_cache_store(embedding, context_key, items):
+    """
+    Append one (embedding, answers) record. It reaches the in-memory
+    index (this process's and others') on the next lookup's sync.
+    """
+    record = {
+        "version": FILL_PROMPT_VERSION,
+        "context": context_key,
+        "embedding": base64.b64encode(embedding.astype(np.float32).tobytes()).decode("ascii"),
+        "items": items,
+    }
+    line = (json.dumps(record) + "\n").encode("utf-8")
+    with _semantic_lock:
+        try:
+            os.makedirs(SEMANTIC_CACHE_DIR, exist_ok=True)
+            with open(_semantic_cache_path(), "a+b") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    if not os.fstat(f.fileno()).st_size:
+                        f.write(_semantic_header())
+                    f.write(line)
+                    f.flush()
+                    if f.tell() > SEMANTIC_CACHE_MAX_BYTES:
+                        _compact_semantic_cache(f)
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+        except OSError as e:
+            print(f"Warning: could not persist semantic cache: {e}")
+
+
+def _compact_semantic_cache(f):
+    """Keep only the newest half of the records (caller holds LOCK_EX)."""
+    f.seek(0)
+    data = f.read()
+    start = data.find(b"\n", len(data) - SEMANTIC_CACHE_MAX_BYTES // 2) + 1
+    f.truncate(0)
+    f.write(_semantic_header() + data[start:])
+    f.flush()
+
+
+# ---------- ASK THE MODEL WHAT TO FILL ----------
+
+# Cheap structural check for "something to fill in": a question mark, a
+# blank line (___), a numbered/lettered item, a bullet, or a line ending
+# in a colon. Pages with none of these (cover pages, pure prose) skip
+# the model entirely.
+FILLABLE_RE = re.compile(
+    r"[?]"
+    r"|_{3,}"
+    r"|^\s*(?:\d+|[A-Za-z])[.)]\s"
+    r"|^\s*[\u2022\u25cf\u25aa\u25e6*-](?:\s|$)"
+    r"|\w:\s*$",
+    re.M,
+)
+
+
+# The static part of the fill prompt. It goes in the system message, ahead
+# of anything that changes per request, so the provider can cache it.
+FILL_INSTRUCTIONS = """You are helping with a school worksheet.
+
+You are given, in the user message:
+1) The FULL text of one or more worksheet pages. Each page starts with a
+   marker line like "===PAGE 1===".
+2) Optionally, ADDITIONAL WORKSHEET INSTRUCTIONS FROM THE USER.
+3) Optionally, a REFERENCE READING / ARTICLE to use whenever relevant.
+
+A worksheet page may include:
 - Section titles and headers
 - Instructions like "For questions 1–3, use Article 2, Clause 3"
 - Labeled blanks like "Birth date: ______; Place of birth: ______"
 - Numbered questions (1., 2., 3., etc.)
 - Bullet lists, including bullets that are blank (for example "• ______")
 
-Your job:
+Your job, for EACH page separately:
 
 1. Find EVERY item a student is expected to fill in. This includes:
    - Direct questions ending in a question mark.
@@ -101,10 +451,10 @@ Your job:
 
 2. For EACH such item, output ONE object:
 
-   {{
+   {
      "prompt": "the exact line / question / label from the page that the answer belongs to",
      "answer": "a short, direct answer the student would write"
-   }}
+   }
 
    IMPORTANT RULES ABOUT THE ANSWER:
    - The answer MUST NOT contain blank placeholders like "______" or "___".
@@ -126,143 +476,561 @@ Your job:
 
 "• case type one\\n• case type two\\n• case type three"
 
-Return ONLY valid JSON in this exact format:
-
-[
-  {{
-    "prompt": "…",
-    "answer": "…"
-  }},
-  ...
-]
+Return ONLY a valid JSON object in this exact format, with one entry per page
+(use the page numbers from the markers, even if a page has no items):
+
+{
+  "pages": [
+    {
+      "page": 1,
+      "items": [
+        {
+          "prompt": "…",
+          "answer": "…"
+        },
+        ...
+      ]
+    },
+    ...
+  ]
+}
 
 Do not include any other text, no explanations.
+"""
 
-WORKSHEET PAGE TEXT:
-\"\"\"{page_text}\"\"\"
+
+def lookup_cached_items(page_text, custom_instructions="", reference_text=""):
+    """
+    Look a page up in the exact and semantic caches.
+
+    Returns (items, embedding): `items` is the cached list or None on a
+    miss; `embedding` is the page's embedding (or None) so the caller can
+    store the fresh answers without embedding the page again.
+    """
+    cache_key = fill_cache_key(page_text, custom_instructions, reference_text)
+    hit = llm_cache.get(cache_key)
+    if hit is not None:
+        return json.loads(hit), None
+
+    # Near-duplicate pages (same questions, different name/date) reuse
+    # earlier answers. Skip tiny pages, which all look alike.
+    embedding = None
+    if len(page_text.split()) >= SEMANTIC_MIN_WORDS:
+        try:
+            embedding = embed_page_text(page_text)
+        except Exception as e:
+            print(f"Warning: embedding failed, skipping semantic cache: {e}")
+        if embedding is not None:
+            context_key = fill_context_key(custom_instructions, reference_text)
+            similar = semantic_cache_lookup(embedding, context_key)
+            # Not copied into the exact tier: a near match stays
+            # subject to the current SEMANTIC_MATCH_THRESHOLD.
+            if similar is not None:
+                return similar, embedding
+
+    return None, embedding
+
+
+def store_cached_items(page_text, items, embedding, custom_instructions="", reference_text=""):
+    """Save freshly generated fill items to both cache tiers."""
+    cache_key = fill_cache_key(page_text, custom_instructions, reference_text)
+    llm_cache.set(cache_key, json.dumps(items))
+    if embedding is not None:
+        context_key = fill_context_key(custom_instructions, reference_text)
+        semantic_cache_store(embedding, context_key, items)
+
+
+def clean_fill_items(data):
+    """Keep only well-formed items whose answer is real content."""
+    cleaned = []
+    if not isinstance(data, list):
+        return cleaned
+
+    for item in data:
+        if not isinstance(item, dict):
+            continue
+        prompt_text = (item.get("prompt") or "").strip()
+        answer_text = (item.get("answer") or "").strip()
+
+        if not prompt_text or not answer_text:
+            continue
+
+        # If the answer still looks like blanks or just copies the prompt, skip it.
+        # 1) Mostly underscores?
+        if "_" in answer_text:
+            non_underscores = "".join(ch for ch in answer_text if ch != "_").strip()
+            # if after removing underscores there's almost nothing left, ignore it
+            if len(non_underscores) < max(3, len(answer_text) // 4):
+                continue
+
+        # 2) Answer basically equals prompt?
+        if answer_text.lower().strip(" .;:") == prompt_text.lower().strip(" .;:"):
+            continue
+
+        cleaned.append({"prompt": prompt_text, "answer": answer_text})
+
+    return cleaned
+
+
+def get_fill_items_for_pages(page_texts, custom_instructions="", reference_text=""):
+    """
+    Ask the model, in ONE request, to find EVERY thing a student is
+    supposed to fill in on each of the given pages:
+    - Questions
+    - Sentences with blanks
+    - Bullet prompts that obviously want answers
+
+    Returns one list per input page, in order, like:
+    [
+      [{"prompt": "...line or question exactly as on the page...", "answer": "...short answer..."}, ...],
+      ...
+    ]
+    A page gets None instead of a list if the reply couldn't be parsed or
+    left that page out, so callers can tell "no items" from "no answer".
+    Errors from the request itself propagate to the caller.
+    """
+    if not page_texts:
+        return []
+
+    # Optional context blocks
+    extra_instr_block = ""
+    if custom_instructions.strip():
+        extra_instr_block = f"""
+ADDITIONAL WORKSHEET INSTRUCTIONS FROM THE USER:
+\"\"\"{custom_instructions.strip()}\"\"\""""
+
+    ref_block = ""
+    if reference_text.strip():
+        ref_block = f"""
+REFERENCE READING / ARTICLE (use this to answer whenever relevant):
+\"\"\"{reference_text.strip()}\"\"\""""
+
+    pages_block = "".join(
+        f"\n\n===PAGE {n}===\n{text}" for n, text in enumerate(page_texts, start=1)
+    )
+
+    # Per-request content only; page text goes last.
+    user_content = f"""{extra_instr_block}
+{ref_block}
+
+WORKSHEET PAGES:{pages_block}
 """
 
     response = client.chat.completions.create(
-        model="gpt-5-mini",
-        messages=[{"role": "user", "content": prompt}]
+        model=FILL_MODEL,
+        messages=[
+            {"role": "system", "content": FILL_INSTRUCTIONS},
+            {"role": "user", "content": user_content.lstrip()},
+        ],
+        response_format={"type": "json_object"},
     )
 
     raw = response.choices[0].message.content
 
+    results = [None] * len(page_texts)
     try:
-        data = json.loads(raw)
-    except json.JSONDecodeError:
-        print("Warning: JSON parse failed for one page, skipping its answers.")
-        return []
+        data = orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        print(f"Warning: JSON parse failed for a batch of {len(page_texts)} page(s), skipping its answers.")
+        return results
 
-    cleaned = []
-    if isinstance(data, list):
-        for item in data:
-            if not isinstance(item, dict):
-                continue
-            prompt_text = (item.get("prompt") or "").strip()
-            answer_text = (item.get("answer") or "").strip()
+    pages = data.get("pages") if isinstance(data, dict) else None
+    if not isinstance(pages, list):
+        print(f"Warning: unexpected JSON shape for a batch of {len(page_texts)} page(s), skipping its answers.")
+        return results
 
-            if not prompt_text or not answer_text:
-                continue
+    for entry in pages:
+        if not isinstance(entry, dict):
+            continue
+        page_no = entry.get("page")
+        if isinstance(page_no, int) and 1 <= page_no <= len(page_texts):
+            if results[page_no - 1] is None:
+                results[page_no - 1] = []
+            results[page_no - 1].extend(clean_fill_items(entry.get("items")))
 
-            # If the answer still looks like blanks or just copies the prompt, skip it.
-            # 1) Mostly underscores?
-            if "_" in answer_text:
-                non_underscores = "".join(ch for ch in answer_text if ch != "_").strip()
-                # if after removing underscores there's almost nothing left, ignore it
-                if len(non_underscores) < max(3, len(answer_text) // 4):
-                    continue
+    missing = sum(1 for r in results if r is None)
+    if missing:
+        print(f"Warning: model reply left out {missing} of {len(page_texts)} page(s) in a batch, skipping their answers.")
 
-            # 2) Answer basically equals prompt?
-            if answer_text.lower().strip(" .;:") == prompt_text.lower().strip(" .;:"):
-                continue
+    return results
 
-            cleaned.append({"prompt": prompt_text, "answer": answer_text})
 
-    return cleaned
+def batch_pages(pending, max_pages=MAX_BATCH_PAGES, max_chars=MAX_BATCH_CHARS):
+    """
+    Group (index, text) pairs into batches for get_fill_items_for_pages,
+    keeping each batch under `max_pages` pages and about `max_chars`
+    characters of page text. A single oversized page gets its own batch.
+    """
+    batches = []
+    current = []
+    current_chars = 0
+    for index, text in pending:
+        if current and (len(current) >= max_pages or current_chars + len(text) > max_chars):
+            batches.append(current)
+            current = []
+            current_chars = 0
+        current.append((index, text))
+        current_chars += len(text)
+    if current:
+        batches.append(current)
+    return batches
+
+
+def iter_items_for_pages(pages, custom_instructions="", reference_text=""):
+    """
+    For each page's text, yield its list of fill items (prompt + answer),
+    in page order, as soon as that page's answers are ready.
+
+    Image-only pages (text None), pages with nothing fillable and pages
+    with cached answers skip the model. The rest are grouped into a few
+    multi-page requests, so the long instructions are sent once per
+    batch rather than once per page, and the batches run in a thread
+    pool. Because this is a generator, the caller can place answers on
+    page 1 while later batches are still with the model. All model work
+    shares one MODEL_STAGE_BUDGET; pages still unanswered when it runs
+    out get [].
+    """
+    if not pages:
+        return
+
+    print(f"Processing {len(pages)} page(s)...")
+    ready = [[] for _ in pages]
+    embeddings = [None] * len(pages)
 
+    fillable = [
+        i for i, text in enumerate(pages)
+        if text and FILLABLE_RE.search(text)
+    ]
+    lookup = partial(
+        lookup_cached_items,
+        custom_instructions=custom_instructions,
+        reference_text=reference_text,
+    )
 
-def build_items_for_pdf(pdf_path, custom_instructions="", reference_text=""):
-    """For each page, get a list of fill items (prompt + answer)."""
-    pages = extract_pages(pdf_path)
-    all_items = []
+    deadline = time.monotonic() + MODEL_STAGE_BUDGET
 
-    for i, page_text in enumerate(pages):
-        print(f"Processing page {i + 1}/{len(pages)}...")
-        items = get_fill_items_from_text(
-            page_text,
-            custom_instructions=custom_instructions,
-            reference_text=reference_text,
-        )
-        print(f"  Found {len(items)} fillable items.")
-        all_items.append(items)
+    def time_left():
+        return max(0.0, deadline - time.monotonic())
 
-    return all_items
+    # Calls still running at the deadline are abandoned rather than
+    # waited on (shutdown(wait=False)). Model answers are cached when
+    # their call finishes, so one that arrives too late for this upload
+    # still serves the next upload of the same worksheet.
+    pending = []
+    if fillable:
+        ex = ThreadPoolExecutor(max_workers=min(MAX_PAGE_WORKERS, len(fillable)))
+        try:
+            lookups = [ex.submit(lookup, pages[i]) for i in fillable]
+            done, _ = wait(lookups, timeout=time_left())
+        finally:
+            ex.shutdown(wait=False, cancel_futures=True)
+        for i, future in zip(fillable, lookups):
+            # A lookup that didn't finish in time counts as a miss.
+            items, embedding = future.result() if future in done else (None, None)
+            embeddings[i] = embedding
+            if items is None:
+                pending.append((i, pages[i]))
+            else:
+                ready[i] = items
+
+    batches = batch_pages(pending)
+    if batches:
+        print(f"  Asking the model about {len(pending)} page(s) in {len(batches)} request(s)...")
+
+    def cache_batch(batch, future):
+        if future.cancelled() or future.exception() is not None:
+            return
+        for (i, text), items in zip(batch, future.result()):
+            # No usable answer for this page; don't cache a failure.
+            if items is not None:
+                store_cached_items(
+                    text, items, embeddings[i],
+                    custom_instructions=custom_instructions,
+                    reference_text=reference_text,
+                )
+
+    ex = ThreadPoolExecutor(max_workers=max(1, min(MAX_PAGE_WORKERS, len(batches))))
+    try:
+        # page index -> (future for its batch, position within the batch)
+        in_flight = {}
+        for n, batch in enumerate(batches):
+            if not time_left():
+                # No time left to wait for an answer; don't pay for one.
+                skipped = sum(len(b) for b in batches[n:])
+                print(f"Warning: no time left to ask the model about {skipped} page(s), skipping them.")
+                break
+            future = ex.submit(
+                get_fill_items_for_pages,
+                [text for _, text in batch],
+                custom_instructions=custom_instructions,
+                reference_text=reference_text,
+            )
+            future.add_done_callback(partial(cache_batch, batch))
+            for pos, (i, _) in enumerate(batch):
+                in_flight[i] = (future, pos)
+
+        for i, text in enumerate(pages):
+            items = ready[i]
+            if i in in_flight:
+                future, pos = in_flight[i]
+                try:
+                    items = future.result(timeout=time_left())[pos]
+                except FuturesTimeout:
+                    print(f"Warning: model did not answer page {i + 1} within {MODEL_STAGE_BUDGET:.0f}s, skipping it.")
+                    items = None
+                except Exception as e:
+                    # A failed request (rate limit, connection error, 5xx
+                    # after retries) costs its batch, not the document.
+                    print(f"Warning: model request failed for page {i + 1}, skipping it: {e}")
+                    items = None
+                if items is None:
+                    items = []
+            if text is None:
+                print(f"  Page {i + 1}: no text layer (scanned?), skipped.")
+            else:
+                print(f"  Page {i + 1}: found {len(items)} fillable items.")
+            yield items
+    finally:
+        ex.shutdown(wait=False, cancel_futures=True)
 
 
 # ---------- FIND WHERE A PROMPT LIVES ON THE PAGE ----------
 
-def find_prompt_anchor(pl_page, prompt_text):
+ANCHOR_STRIP_CHARS = ".,?!:;"
+
+# Drops the punctuation above and lowercases ASCII in a single C-level
+# pass. Non-ASCII words still go through str.lower() for full Unicode
+# case folding.
+_DROP_PUNCT = str.maketrans("", "", ANCHOR_STRIP_CHARS)
+_DROP_PUNCT_LOWER = str.maketrans(
+    {**{c: None for c in ANCHOR_STRIP_CHARS},
+     **{chr(c): chr(c + 32) for c in range(ord("A"), ord("Z") + 1)}}
+)
+
+
+def normalize_word(word):
+    """Normalize a word for anchor matching (no punctuation, lowercase)."""
+    if word.isascii():
+        return word.translate(_DROP_PUNCT_LOWER)
+    return word.translate(_DROP_PUNCT).lower()
+
+
+def index_page_words(texts):
+    """
+    Intern each normalized page word to a small integer id, so prompt
+    matching is an integer comparison, and record where each id occurs.
+    Build this once per page and reuse it for every prompt on that page.
+
+    Returns (page_ids, vocab, positions), where positions[id] is an int32
+    array of the word indexes holding that id.
+    """
+    vocab = {}
+    positions = defaultdict(list)
+    ids = []
+    for n, t in enumerate(texts):
+        word_id = vocab.setdefault(normalize_word(t), len(vocab))
+        ids.append(word_id)
+        positions[word_id].append(n)
+    page_ids = np.array(ids, dtype=np.int32)
+    positions = {word_id: np.array(p, dtype=np.int32) for word_id, p in positions.items()}
+    return page_ids, vocab, positions
+
+
+def candidate_windows(positions, snip_ids, num_windows):
+    """
+    Window starts that can possibly reach the match threshold.
+
+    find_prompt_anchor accepts at most one mismatched word per window, so
+    a match must have the snippet's first or second word in place. Only
+    windows starting at an occurrence of word 0, or one before an
+    occurrence of word 1, are worth scoring.
+    """
+    empty = np.empty(0, dtype=np.int32)
+    starts = np.union1d(
+        positions.get(int(snip_ids[0]), empty),
+        positions.get(int(snip_ids[1]), empty) - 1,
+    ).astype(np.int32)
+    return starts[(starts >= 0) & (starts < num_windows)]
+
+
+@njit(cache=True)
+def best_matching_window(page_ids, snip_ids, starts):
+    """
+    Score `snip_ids` against the windows of `page_ids` beginning at each
+    of the (sorted) `starts`, counting position-wise matches.
+
+    Returns (best_index, best_score) for the first window with the top
+    score, or (-1, 0) if nothing matches at all.
+    """
+    k = snip_ids.shape[0]
+    best_index = -1
+    best_score = 0
+    for s in range(starts.shape[0]):
+        i = starts[s]
+        score = 0
+        for j in range(k):
+            if page_ids[i + j] == snip_ids[j]:
+                score += 1
+        if score > best_score:
+            best_score = score
+            best_index = i
+    return best_index, best_score
+
+
+def find_prompt_anchor(words, word_index, prompt_text):
     """
     Try to find where the prompt appears on the page using words + positions.
 
+    `words` is the page's `extract_page_words()` output, (texts, x0, y0),
+    and `word_index` is `index_page_words(texts)`; both are computed once
+    per page by the caller.
+
     Returns (x_from_left, y_from_bottom) in PDF coordinates for where to place
     the answer, or None if not found.
 
     This keeps the logic simple:
     - Take the first few words of the prompt.
-    - Slide over all words on the page and score how many match in order.
+    - Slide over the page's words and score how many match in order
+      (only at windows that could pass, see candidate_windows).
     - Require at least a few matches, then use that snippet's position.
     """
-    words = pl_page.extract_words()
-    if not words:
+    texts, x0, y0 = words
+    if not texts:
         return None
 
-    page_height = pl_page.height
+    page_ids, vocab, positions = word_index
 
     p_words = prompt_text.split()
-    if not p_words:
+    snippet_len = min(len(p_words), 6)
+    # Require at least 3 matching words (or almost all)
+    min_required = max(3, snippet_len - 1)
+    if snippet_len < min_required or len(page_ids) < snippet_len:
         return None
 
-    snippet_len = min(len(p_words), 6)
-    snippet = [w.strip(".,?!:;").lower() for w in p_words[:snippet_len]]
-    if not snippet:
+    # Words that never occur on the page get -1, which matches nothing.
+    snip_ids = np.array(
+        [vocab.get(normalize_word(w), -1) for w in p_words[:snippet_len]],
+        dtype=np.int32,
+    )
+
+    starts = candidate_windows(positions, snip_ids, len(page_ids) - snippet_len + 1)
+    best_index, best_score = best_matching_window(page_ids, snip_ids, starts)
+
+    if best_index < 0 or best_score < min_required:
         return None
 
-    page_words = [w["text"] for w in words]
+    end = best_index + snippet_len
+    return float(x0[best_index:end].min()), float(y0[best_index:end].min())
 
-    best_index = None
-    best_score = 0
 
-    for i in range(0, len(page_words) - snippet_len + 1):
-        window = page_words[i:i + snippet_len]
-        window_clean = [w.strip(".,?!:;").lower() for w in window]
-        score = sum(1 for a, b in zip(snippet, window_clean) if a == b)
-        if score > best_score:
-            best_score = score
-            best_index = i
+# ---------- WRITE ANSWERS BACK TO THE PDF ----------
 
-    # Require at least 3 matching words (or almost all)
-    min_required = max(3, snippet_len - 1)
-    if best_index is None or best_score < min_required:
-        return None
+# Wrap answers into lines so they don't run off the page. One shared
+# wrapper instead of building a new TextWrapper for every answer chunk.
+ANSWER_WRAP_WIDTH = 80  # number of characters per line (rough)
+_answer_wrapper = textwrap.TextWrapper(width=ANSWER_WRAP_WIDTH)
+
+
+def wrap_answer(answer_text):
+    """Split an answer into drawable lines, keeping its own line breaks."""
+    lines = []
+    for chunk in answer_text.split("\n"):
+        lines.extend(_answer_wrapper.wrap(chunk) or [""])
+    return lines
+
+
+# Answers are written as raw PDF text operators appended to each page's
+# content stream, using the built-in Helvetica. The resource name is
+# unusual on purpose so it can't clash with the page's own fonts.
+ANSWER_FONT = "/WFHelv"
+ANSWER_FONT_SIZE = 9
+ANSWER_LINE_SPACING = 12
+ANSWER_BOTTOM_MARGIN = 40  # don't draw into the bottom margin
+
+
+def pdf_literal(text):
+    """Encode text as a PDF literal string for a WinAnsi (Helvetica) font."""
+    raw = text.encode("cp1252", errors="replace")
+    raw = (
+        raw.replace(b"\\", b"\\\\")
+        .replace(b"(", b"\\(")
+        .replace(b")", b"\\)")
+        .replace(b"\r", b"\\r")
+    )
+    return b"(" + raw + b")"
 
-    snippet_words = words[best_index:best_index + snippet_len]
-    x0 = min(float(w["x0"]) for w in snippet_words)
-    bottoms = [float(w["bottom"]) for w in snippet_words]
-    bottom_from_top = max(bottoms)
 
-    y_from_bottom = page_height - bottom_from_top
-    return x0, y_from_bottom
+def draw_text_commands(x, y, lines, font=ANSWER_FONT, size=ANSWER_FONT_SIZE,
+                       leading=ANSWER_LINE_SPACING):
+    """
+    Return content-stream bytes that draw `lines` top to bottom, the first
+    baseline at (x, y) and each following line `leading` points lower.
+    """
+    ops = [b"BT", f"{font} {size} Tf {leading} TL {x:.2f} {y:.2f} Td".encode("ascii")]
+    for n, line in enumerate(lines):
+        if n:
+            ops.append(b"T*")
+        ops.append(pdf_literal(line) + b" Tj")
+    ops.append(b"ET")
+    return b"\n".join(ops)
+
+
+def answer_font_resource():
+    """The font dictionary for ANSWER_FONT: built-in Helvetica, WinAnsi."""
+    return DictionaryObject({
+        NameObject("/Type"): NameObject("/Font"),
+        NameObject("/Subtype"): NameObject("/Type1"),
+        NameObject("/BaseFont"): NameObject("/Helvetica"),
+        NameObject("/Encoding"): NameObject("/WinAnsiEncoding"),
+    })
+
+
+def add_answer_font(page, font_ref):
+    """
+    Make ANSWER_FONT available in the page's /Resources, pointing at the
+    document's shared font object `font_ref` (an IndirectObject).
+    """
+    resources = page.get("/Resources")
+    if resources is None:
+        resources = DictionaryObject()
+        page[NameObject("/Resources")] = resources
+    resources = resources.get_object()
 
+    fonts = resources.get("/Font")
+    if fonts is None:
+        fonts = DictionaryObject()
+        resources[NameObject("/Font")] = fonts
+    fonts = fonts.get_object()
 
-# ---------- WRITE ANSWERS BACK TO THE PDF ----------
+    fonts[NameObject(ANSWER_FONT)] = font_ref
+
+
+def append_to_page_contents(writer, page, commands):
+    """
+    Append content-stream bytes after the page's existing contents.
 
-def overlay_answers_on_pdf(original_pdf, items_by_page, output_pdf):
+    The original contents are wrapped in q/Q so any graphics state they
+    leave behind (transforms, colours) doesn't affect our text.
+    """
+    old = page.get_contents()
+    data = b"q\n" + (old.get_data() if old is not None else b"") + b"\nQ\n"
+    data += b"q 0 g\n" + commands + b"\nQ\n"
+
+    stream = ContentStream(None, writer)
+    stream.set_data(data)
+    page.replace_contents(stream.flate_encode())
+
+
+def overlay_answers_on_pdf(original_pdf, words_by_page, items_by_page, output_pdf):
     """
     Draw answers onto a copy of the original PDF.
 
+    pypdf only reads `original_pdf` (a path or binary stream) to copy and
+    write the pages. `words_by_page` holds the word positions read
+    alongside the page text (see extract_worksheet_pages), used to locate
+    prompts. `items_by_page` may be any iterable of per-page item lists,
+    consumed one page at a time.
+
     For each page:
     - For each (prompt, answer), find where the prompt's text is.
     - Draw the answer underneath that line, left-aligned with the prompt.
@@ -271,75 +1039,94 @@ def overlay_answers_on_pdf(original_pdf, items_by_page, output_pdf):
     reader = PdfReader(original_pdf)
     writer = PdfWriter()
     num_pages = len(reader.pages)
+    # Registered once as an indirect object, so every page's /Font entry
+    # references the same font instead of carrying its own inline copy.
+    # pypdf has no public call for adding a bare object to a writer.
+    answer_font = writer._add_object(answer_font_resource())
+
+    page_items_iter = iter(items_by_page)
+    for i in range(num_pages):
+        page = reader.pages[i]
+        page_items = next(page_items_iter, [])
+
+        words = words_by_page[i] if i < len(words_by_page) else None
+        if not page_items or words is None:
+            # No answers (or an image-only page); just copy
+            writer.add_page(page)
+            continue
 
-    with pdfplumber.open(original_pdf) as pl_doc:
-        for i in range(num_pages):
-            page = reader.pages[i]
+        # Build the word index once per page, not once per prompt.
+        word_index = index_page_words(words[0])
 
-            if i >= len(items_by_page) or not items_by_page[i]:
-                # No answers for this page; just copy
-                writer.add_page(page)
+        commands = []
+        for item in page_items:
+            prompt_text = item.get("prompt", "") or ""
+            answer_text = item.get("answer", "") or ""
+            if not prompt_text or not answer_text:
                 continue
 
-            pl_page = pl_doc.pages[i]
-            page_height = float(page.mediabox.height)
-            page_width = float(page.mediabox.width)
-
-            # Create a transparent overlay with reportlab
-            packet = io.BytesIO()
-            can = canvas.Canvas(packet, pagesize=(page_width, page_height))
-            can.setFont("Helvetica", 9)
-
-            for item in items_by_page[i]:
-                prompt_text = item.get("prompt", "") or ""
-                answer_text = item.get("answer", "") or ""
-                if not prompt_text or not answer_text:
-                    continue
-
-                anchor = find_prompt_anchor(pl_page, prompt_text)
-                if anchor is None:
-                    # Can't find where this line is; skip to avoid random placement
-                    continue
-
-                base_x, base_y = anchor
-                x = base_x
-                y = base_y - 14  # a bit below the prompt line
-
-                # Wrap the answer into lines so it doesn't run off the page
-                wrap_width = 80  # number of characters per line (rough)
-                lines = []
-                for chunk in answer_text.split("\n"):
-                    lines.extend(textwrap.wrap(chunk, width=wrap_width) or [""])
-
-                for line in lines:
-                    y -= 12
-                    if y < 40:  # don't draw into the bottom margin
-                        break
-                    can.drawString(x, y, line)
-
-            can.save()
-            packet.seek(0)
+            anchor = find_prompt_anchor(words, word_index, prompt_text)
+            if anchor is None:
+                # Can't find where this line is; skip to avoid random placement
+                continue
 
-            try:
-                overlay_pdf = PdfReader(packet)
-                if len(overlay_pdf.pages) == 0:
-                    # Nothing actually drawn; just copy the page
-                    writer.add_page(page)
-                    continue
-
-                overlay_page = overlay_pdf.pages[0]
-                page.merge_page(overlay_page)
-            except Exception as e:
-                # If anything goes wrong with merging, log and fall back to original page
-                print(f"Warning: overlay merge failed on page {i+1}: {e}")
-                # Just keep original page
+            base_x, base_y = anchor
+            x = base_x
+            y = base_y - 14  # a bit below the prompt line
 
-            writer.add_page(page)
+            lines = []
+            for line in wrap_answer(answer_text):
+                y -= ANSWER_LINE_SPACING
+                if y < ANSWER_BOTTOM_MARGIN:
+                    break
+                lines.append(line)
 
-    with open(output_pdf, "wb") as f:
+            if lines:
+                first_y = base_y - 14 - ANSWER_LINE_SPACING
+                commands.append(draw_text_commands(x, first_y, lines))
+
+        out_page = writer.add_page(page)
+        if not commands:
+            # Nothing actually drawn; the copied page is enough
+            continue
+
+        try:
+            add_answer_font(out_page, answer_font)
+            append_to_page_contents(writer, out_page, b"\n".join(commands))
+        except Exception as e:
+            # If anything goes wrong, log and fall back to the original page
+            print(f"Warning: drawing answers failed on page {i+1}: {e}")
+
+    with open(output_pdf, "wb", buffering=IO_BUFFER_SIZE) as f:
         writer.write(f)
 
 
+def fill_pdf(input_pdf, output_pdf, custom_instructions="", reference_text=""):
+    """
+    Fill a worksheet PDF end to end.
+
+    PDFium reads each page once, up front, for both the text sent to the
+    model and the word positions used to anchor answers; it is closed
+    before any model calls, so its memory isn't held while we wait.
+    """
+    pdf_doc = pdfium.PdfDocument(input_pdf)
+    try:
+        pages_text, words_by_page = extract_worksheet_pages(pdf_doc)
+    finally:
+        pdf_doc.close()
+
+    with ExitStack() as stack:
+        # The model stage and the overlay stage are pipelined: each page
+        # is overlaid as soon as its answers arrive.
+        print("Filling uploaded PDF...")
+        items_by_page = iter_items_for_pages(
+            pages_text,
+            custom_instructions=custom_instructions,
+            reference_text=reference_text,
+        )
+        overlay_answers_on_pdf(open_pdf_stream(input_pdf, stack), words_by_page, items_by_page, output_pdf)
+
+
 # ---------- FLASK ROUTES ----------
 
 @app.route("/", methods=["GET", "POST"])
@@ -381,16 +1168,13 @@ def index():
         output_path = tmp_out.name
 
     try:
-        print("Building fill items for uploaded PDF...")
-        items_by_page = build_items_for_pdf(
+        fill_pdf(
             input_path,
+            output_path,
             custom_instructions=custom_instructions,
             reference_text=reference_text,
         )
 
-        print("Overlaying answers onto PDF...")
-        overlay_answers_on_pdf(input_path, items_by_page, output_path)
-
         return send_file(
             output_path,
             mimetype="application/pdf",